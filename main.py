@@ -1,11 +1,23 @@
+import asyncio
+import hashlib
+import heapq
 import os
 import re
-import requests
-from typing import Dict, Any, List
-
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse, FileResponse
+import time
+import uuid
+from contextlib import asynccontextmanager
+from email.utils import formatdate
+from functools import lru_cache
+from operator import itemgetter
+from pathlib import Path
+from typing import Dict, Any, List, NamedTuple
+
+import httpx
+import orjson
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from dotenv import load_dotenv
 
 # -------------------------------------------------
@@ -16,7 +28,36 @@ load_dotenv()
 APIFY_TOKEN = os.getenv("APIFY_TOKEN")
 ACTOR_ID = os.getenv("APIFY_ACTOR_ID")  # p.ej. "lukass~idealista-scraper"
 
-app = FastAPI()
+# -------------------------------------------------
+# Cliente HTTP compartido (asíncrono)
+# -------------------------------------------------
+# Un único AsyncClient por proceso: mientras Apify trabaja, el worker
+# sigue atendiendo otras búsquedas en lugar de quedarse bloqueado.
+http_client: httpx.AsyncClient | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(60.0),
+        # httpx ya anuncia gzip (y br con brotli instalado) y descomprime solo
+        headers={"Accept": "application/json"},
+        # conexiones keep-alive (HTTP/2) reutilizadas entre búsquedas (sin TLS por llamada)
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            retries=3,
+        ),
+    )
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+        http_client = None
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,26 +66,81 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Las respuestas de /buscar y la UI comprimen bien (~5x)
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+
+def json_response(content: Any, status_code: int = 200) -> Response:
+    # orjson directamente: ORJSONResponse está obsoleta en FastAPI reciente
+    return Response(
+        content=orjson.dumps(content),
+        status_code=status_code,
+        media_type="application/json",
+    )
+
 # -------------------------------------------------
 # Parsing de la consulta en lenguaje natural
 # -------------------------------------------------
-def parse_query(q: str) -> Dict[str, Any]:
-    """
-    Interpreta la frase libre y devuelve:
-      - ok: bool
-      - missing: lista de cosas que faltan
-      - location_query: texto de ubicación (ciudad/barrio/CP/calle)
-      - city: ciudad principal (para mostrar mensajes)
-      - price_max: presupuesto máximo (€)
-      - for_rent: True si parece alquiler
-      - num_props: nº de viviendas deseadas (por defecto 5)
-    """
+_RE_NUM_PROPS = re.compile(r"(\d+)\s+(pisos?|apartamentos?|viviendas?|casas?)")
+_RE_MIL = re.compile(r"(\d+)\s*mil")
+_RE_DIGITS = re.compile(r"\d+")
+_RE_CP = re.compile(r"\b(\d{5})\b")
+# alquiler, alquilar, alquilarlos, arrendar, renta, renting... ("rentable" no)
+_RE_RENT = re.compile(r"\b(?:alquil\w*|arrend\w*|renta|rentas|rentar|renting)\b")
+# Fin de la zona tras " en " (y de la ubicación principal, que corta también en " y ")
+_RE_ZONA_END = re.compile(r" por | para | que |\.")
+_RE_LOCATION_END = re.compile(r" y ")
+_RE_LOCATION_SEP = re.compile(r",| y | o ")
+
+_CIUDADES = (
+    "madrid",
+    "barcelona",
+    "valencia",
+    "malaga",
+    "sevilla",
+    "bilbao",
+    "zaragoza",
+    "cordoba",
+    "alicante",
+    "murcia",
+    "granada",
+    "vigo",
+    "gijon",
+    "oviedo",
+    "donostia",
+    "san sebastian",
+)
+_CIUDADES_SET = frozenset(_CIUDADES)
+# Las ciudades van sin tildes: para reconocerlas, "málaga" -> "malaga".
+# location_query (lo que se muestra al usuario) se queda como la ha escrito;
+# las ciudades conocidas se buscan siempre por su nombre de la lista, para
+# que "Málaga" y "malaga" compartan caché y run de Apify.
+_ACCENT_TBL = str.maketrans("áéíóúàèìòùäëïöü", "aeiouaeiouaeiou")
+# Una sola pasada sobre la consulta para todas las ciudades
+_RE_CITY = re.compile(r"\b(" + "|".join(re.escape(c) for c in _CIUDADES) + r")\b")
+
+
+class ParsedQuery(NamedTuple):
+    ok: bool
+    missing: tuple[str, ...]
+    location_query: str | None
+    locations: tuple[str, ...]
+    city: str
+    price_max: int | None
+    for_rent: bool
+    num_props: int
+
+
+# parse_query es pura: las consultas repetidas (reintentos, ejemplos de la UI)
+# no vuelven a pasar por las regex
+@lru_cache(maxsize=1024)
+def _parse_query_cached(q: str) -> ParsedQuery:
     q_low = q.lower()
     missing: List[str] = []
 
     # 1) Nº de pisos: "5 pisos", "3 apartamentos", etc.
     num_props = 5
-    m_props = re.search(r"(\d+)\s+(pisos?|apartamentos?|viviendas?|casas?)", q_low)
+    m_props = _RE_NUM_PROPS.search(q_low)
     if m_props:
         try:
             num_props = int(m_props.group(1))
@@ -55,11 +151,11 @@ def parse_query(q: str) -> Dict[str, Any]:
     price_max = None
 
     # Formatos tipo "150 mil"
-    m_mil = re.search(r"(\d+)\s*mil", q_low)
+    m_mil = _RE_MIL.search(q_low)
     if m_mil:
         price_max = int(m_mil.group(1)) * 1000
     else:
-        nums = [int(x) for x in re.findall(r"\d+", q_low)]
+        nums = [int(x) for x in _RE_DIGITS.findall(q_low)]
         if nums:
             big_nums = [n for n in nums if n >= 5000]
             price_max = max(big_nums) if big_nums else nums[-1]
@@ -68,54 +164,29 @@ def parse_query(q: str) -> Dict[str, Any]:
         missing.append("presupuesto máximo (ej. 'por 300000 euros')")
 
     # 3) Compra o alquiler
-    for_rent = any(
-        x in q_low
-        for x in ["alquiler", "alquilar", "renta", "renting", "alquilarla", "alquilarlos"]
-    )
+    for_rent = bool(_RE_RENT.search(q_low))
 
     # 4) Ubicación / ciudad
     location_query = None
 
-    # Intento 1: todo lo que hay después de " en "
-    if " en " in q_low:
-        after_en = q_low.split(" en ")[-1]
-        for cutter in [" por ", " para ", " que ", " y ", "."]:
-            if cutter in after_en:
-                after_en = after_en.split(cutter)[0]
-        location_query = after_en.strip(" ,.")
-        if not location_query:
-            location_query = None
-
-    # Intento 2: lista de ciudades conocidas
-    ciudades = [
-        "madrid",
-        "barcelona",
-        "valencia",
-        "malaga",
-        "sevilla",
-        "bilbao",
-        "zaragoza",
-        "cordoba",
-        "alicante",
-        "murcia",
-        "granada",
-        "vigo",
-        "gijon",
-        "oviedo",
-        "donostia",
-        "san sebastian",
-    ]
-    city = None
-    for c in ciudades:
-        if c in q_low:
-            city = c
-            if not location_query:
-                location_query = c
-            break
+    # Intento 1: lo que hay tras el último " en ", hasta " por ", " para "...
+    _, en, zona = q_low.rpartition(" en ")
+    if en:
+        zona = _RE_ZONA_END.split(zona, 1)[0]
+        location_query = _RE_LOCATION_END.split(zona, 1)[0].strip(" ,.") or None
+    else:
+        # Sin " en " no hay zona: el paso 5 no debe buscar ciudades en toda la frase
+        zona = ""
+
+    # Intento 2: lista de ciudades conocidas (en orden de prioridad)
+    encontradas = set(_RE_CITY.findall(q_low.translate(_ACCENT_TBL)))
+    city = next((c for c in _CIUDADES if c in encontradas), None)
+    if city and not location_query:
+        location_query = city
 
     # Intento 3: código postal (5 dígitos)
     if not location_query:
-        m_cp = re.search(r"\b(\d{5})\b", q_low)
+        m_cp = _RE_CP.search(q_low)
         if m_cp:
             location_query = m_cp.group(1)
 
@@ -128,33 +199,102 @@ def parse_query(q: str) -> Dict[str, Any]:
     if city is None:
         city = "madrid"  # fallback
 
+    # 5) Ubicaciones a buscar. Varias ciudades: "en madrid y barcelona",
+    #    "en sevilla, malaga o cordoba"
+    locations = []
+    if location_query:
+        plegada = location_query.translate(_ACCENT_TBL)
+        locations = [plegada if plegada in _CIUDADES_SET else location_query]
+    partes = [x.strip(" ,.") for x in _RE_LOCATION_SEP.split(zona)]
+    partes = list(dict.fromkeys(x for x in partes if x))
+    ciudades = [x.translate(_ACCENT_TBL) for x in partes]
+    if len(ciudades) > 1 and _CIUDADES_SET.issuperset(ciudades):
+        locations = list(dict.fromkeys(ciudades))
+
     ok = len(missing) == 0
 
-    return {
-        "ok": ok,
-        "missing": missing,
-        "location_query": location_query,
-        "city": city,
-        "price_max": price_max,
-        "for_rent": for_rent,
-        "num_props": num_props,
-    }
+    return ParsedQuery(
+        ok=ok,
+        missing=tuple(missing),
+        location_query=location_query,
+        locations=tuple(locations),
+        city=city,
+        price_max=price_max,
+        for_rent=for_rent,
+        num_props=num_props,
+    )
+
+
+def parse_query(q: str) -> Dict[str, Any]:
+    """
+    Interpreta la frase libre y devuelve:
+      - ok: bool
+      - missing: lista de cosas que faltan
+      - location_query: texto de ubicación (ciudad/barrio/CP/calle)
+      - locations: ubicaciones a buscar (varias si se piden varias ciudades)
+      - city: ciudad principal (para mostrar mensajes)
+      - price_max: presupuesto máximo (€)
+      - for_rent: True si parece alquiler
+      - num_props: nº de viviendas deseadas (por defecto 5)
+    """
+    info = _parse_query_cached(q)._asdict()
+    info["missing"] = list(info["missing"])
+    info["locations"] = list(info["locations"])
+    return info
 
 # -------------------------------------------------
 # Rutas de UI estática
 # -------------------------------------------------
+# La UI es un único HTML estático junto a main.py: lo leemos una vez al arrancar
+UI_PATH = Path(__file__).with_name("ui.html")
+UI_HTML = UI_PATH.read_bytes()
+# ETag débil: GZipMiddleware sirve el mismo contenido comprimido o no con
+# la misma etiqueta, y una etiqueta fuerte tendría que cambiar con la codificación
+UI_ETAG = f'"{hashlib.md5(UI_HTML).hexdigest()}"'
+UI_HEADERS = {
+    "ETag": f"W/{UI_ETAG}",
+    "Last-Modified": formatdate(UI_PATH.stat().st_mtime, usegmt=True),
+    # 5 min sin volver a preguntar; después, revalidación barata con el ETag
+    "Cache-Control": "public, max-age=300",
+}
+
+
 @app.get("/")
-def ui():
-    return FileResponse("ui.html")
+def ui(request: Request):
+    # El navegador ya tiene esta versión: 304 sin cuerpo
+    if_none_match = request.headers.get("if-none-match", "")
+    # If-None-Match usa comparación débil: se ignora el prefijo W/
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    if UI_ETAG in tags or "*" in tags:
+        return Response(status_code=304, headers=UI_HEADERS)
+    return Response(content=UI_HTML, media_type="text/html", headers=UI_HEADERS)
 
 # -------------------------------------------------
 # Utilidades de negocio
 # -------------------------------------------------
+# Rentabilidad bruta anual supuesta para estimar el alquiler de una compra
+GROSS_RENT_YIELD = 0.04
+
+
+def estimate_monthly_rent(precio: int) -> int:
+    return int(precio * GROSS_RENT_YIELD / 12)
+
+
+# Precio en texto: "439000", "439.000 €", "439 000€". Solo se quitan los
+# separadores de miles; decimales o signos ("299000.50", "1.5", "-5") no valen.
+_RE_PRICE = re.compile(r"\s*(\d{1,3}(?:[.\s]\d{3})+|\d+)\s*€?\s*")
+
+
 def safe_price(piso: Dict[str, Any]) -> int:
-    try:
-        return int(piso.get("price"))
-    except Exception:
-        return -1
+    # Sin try/except: esta función se llama para cada anuncio
+    v = piso.get("price")
+    if isinstance(v, (int, float)):
+        return int(v)
+    if isinstance(v, str):
+        m = _RE_PRICE.fullmatch(v)
+        if m:
+            return int("".join(_RE_DIGITS.findall(m.group(1))))
+    return -1
 
 def build_intro(info: Dict[str, Any], rango_min: int | None, rango_max: int | None) -> str:
     ciudad = info["city"]
@@ -192,14 +332,315 @@ def build_intro(info: Dict[str, Any], rango_min: int | None, rango_max: int | No
 
     return intro
 
+# -------------------------------------------------
+# Llamada a Apify (con caché TTL)
+# -------------------------------------------------
+# Los anuncios no cambian de un minuto para otro: guardamos el resultado de
+# cada ejecución del actor durante CACHE_TTL_S segundos.
+CACHE_TTL_S = int(os.getenv("APIFY_CACHE_TTL_S", "600"))
+
+# Parte fija del input del actor; por búsqueda solo cambian
+# district, operation y maxItems
+APIFY_RUN_INPUT_BASE: Dict[str, Any] = {
+    "country": "es",
+    "propertyType": "homes",
+    "endPage": 50,
+    "proxy": {
+        "useApifyProxy": True,
+        "apifyProxyGroups": ["RESIDENTIAL"],
+    },
+    "minSize": "any",
+    "maxSize": "any",
+    "bedrooms": [],
+    "bathrooms": [],
+    "homeType": [],
+    "condition": [],
+    "propertyStatus": [],
+    "floorHeights": [],
+    "features": [],
+}
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Anuncios a pedir al actor: ~30 por vivienda pedida para que la banda de
+# precio tenga donde elegir, sin pasar de 150 (el límite de siempre).
+# Apify cobra por resultado: se puede ajustar por entorno según lo que se
+# vea en meta.total_candidates.
+APIFY_ITEMS_PER_PROP = int(os.getenv("APIFY_ITEMS_PER_PROP", "30"))
+APIFY_MIN_ITEMS = int(os.getenv("APIFY_MIN_ITEMS", "60"))
+APIFY_MAX_ITEMS = 150
+
+
+def apify_max_items(num_props: int) -> int:
+    return min(max(num_props * APIFY_ITEMS_PER_PROP, APIFY_MIN_ITEMS), APIFY_MAX_ITEMS)
+
+# Solo pedimos a Apify los campos que usamos para montar la respuesta
+APIFY_ITEM_FIELDS = "price,address,url,photos,typology,title"
+
+# URLs fijas del actor (token y actor no cambian mientras vive el proceso)
+APIFY_API = "https://api.apify.com/v2"
+APIFY_RUNS_URL = f"{APIFY_API}/acts/{ACTOR_ID}/runs?token={APIFY_TOKEN}"
+
+# waitForFinish: Apify retiene la respuesta hasta que el run termina o pasan
+# N segundos (máximo 60). El timeout del cliente queda holgado por encima para
+# que sea Apify quien conteste, y en total esperamos un run como mucho 600 s.
+APIFY_WAIT_FOR_FINISH_S = 60
+APIFY_WAIT_TIMEOUT_S = APIFY_WAIT_FOR_FINISH_S + 30
+APIFY_POLL_TIMEOUT_S = 600
+APIFY_TERMINAL_STATUSES = {"SUCCEEDED", "FAILED", "TIMED-OUT", "ABORTED"}
+
+# Máximo de ejecuciones del actor en paralelo por proceso (límites de Apify)
+APIFY_MAX_CONCURRENT_RUNS = 5
+_apify_semaphore = asyncio.Semaphore(APIFY_MAX_CONCURRENT_RUNS)
+
+# Errores transitorios de Apify que merece la pena reintentar. Un POST lanza
+# un run (y Apify lo cobra): tras un 5xx puede que ya esté en marcha, así que
+# solo se repite con 429. Los fallos de conexión ya los reintenta el transporte.
+APIFY_RETRY_ATTEMPTS = 4
+APIFY_RETRY_STATUSES = {
+    "GET": (429, 500, 502, 503, 504),
+    "POST": (429,),
+}
+# Tope para el Retry-After que nos pida Apify
+APIFY_RETRY_AFTER_MAX_S = 30
+
+# clave -> (momento en que se guardó, items)
+_apify_cache: Dict[str, tuple[float, List[Dict[str, Any]]]] = {}
+# clave -> ejecución en curso, para que búsquedas idénticas simultáneas
+# esperen a la misma llamada en lugar de lanzar el actor varias veces
+_apify_inflight: Dict[str, asyncio.Task[List[Dict[str, Any]]]] = {}
+# consulta ya interpretada -> (momento de los datos de Apify, cuerpo JSON de /buscar).
+# Cada presupuesto distinto es una entrada aunque reutilice el mismo run de
+# Apify: como mucho RESPONSE_CACHE_MAXSIZE, y al llenarse sale la más antigua
+# (el dict conserva el orden de inserción).
+RESPONSE_CACHE_MAXSIZE = 512
+_response_cache: Dict[ParsedQuery, tuple[float, bytes]] = {}
+
+
+async def _apify_request(method: str, url: str, **kwargs: Any) -> httpx.Response:
+    """
+    Petición a la API de Apify reintentando los errores transitorios de
+    APIFY_RETRY_STATUSES. Espera lo que indique Retry-After o, si no viene,
+    con backoff exponencial (0.5s, 1s, 2s... hasta 8s). Devuelve la última
+    respuesta sin lanzar.
+    """
+    retry_statuses = APIFY_RETRY_STATUSES.get(method, ())
+    for attempt in range(APIFY_RETRY_ATTEMPTS):
+        resp = await http_client.request(method, url, **kwargs)
+        if resp.status_code not in retry_statuses or attempt == APIFY_RETRY_ATTEMPTS - 1:
+            return resp
+        await asyncio.sleep(_retry_delay(resp, attempt))
+    return resp
+
+
+def _backoff(attempt: int) -> float:
+    """Espera exponencial compartida por reintentos y sondeos: 0.5s, 1s, 2s... hasta 8s."""
+    return min(0.5 * 2**attempt, 8)
+
+
+def _retry_delay(resp: httpx.Response, attempt: int) -> float:
+    retry_after = resp.headers.get("retry-after", "")
+    if retry_after.isdigit():
+        return min(int(retry_after), APIFY_RETRY_AFTER_MAX_S)
+    return _backoff(attempt)
+
+
+async def _run_actor(location: str, for_rent: bool, max_items: int) -> List[Dict[str, Any]]:
+    async with _apify_semaphore:
+        items = await _run_actor_async(location, for_rent, max_items)
+
+    # Nos quedamos solo con lo que muestra /buscar: el resto del anuncio
+    # no se queda en memoria (ni en caché)
+    if isinstance(items, list):
+        return [_slim_item(item) for item in items if isinstance(item, dict)]
+    return items
+
+
+def _slim_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    fotos = item.get("photos")
+    foto = ""
+    if isinstance(fotos, list) and fotos and isinstance(fotos[0], dict):
+        foto = fotos[0].get("url") or ""
+    return {
+        "price": item.get("price"),
+        "address": item.get("address"),
+        "url": item.get("url"),
+        "photo": foto,
+        "typology": item.get("typology"),
+        "title": item.get("title"),
+    }
+
+
+async def _run_actor_async(location: str, for_rent: bool, max_items: int) -> List[Dict[str, Any]]:
+    # --------- Llamada al actor lukass~idealista-scraper ----------
+    payload = orjson.dumps(
+        {
+            **APIFY_RUN_INPUT_BASE,
+            "district": location,
+            "operation": "rent" if for_rent else "sale",
+            "maxItems": max_items,
+        }
+    )
+
+    # Un único run por búsqueda: casi siempre vuelve ya terminado; si no,
+    # seguimos consultando ese mismo run en lugar de lanzar otro
+    run_res = await _apify_request(
+        "POST",
+        f"{APIFY_RUNS_URL}&waitForFinish={APIFY_WAIT_FOR_FINISH_S}",
+        content=payload,
+        headers=JSON_HEADERS,
+        timeout=APIFY_WAIT_TIMEOUT_S,
+    )
+    run_res.raise_for_status()
+    run = orjson.loads(run_res.content)["data"]
+
+    estado = await _wait_for_run(run["id"], run.get("status"))
+    if estado != "SUCCEEDED":
+        raise RuntimeError(f"La ejecución {run['id']} de Apify terminó con estado {estado}")
+
+    items_url = (
+        f"{APIFY_API}/datasets/{run['defaultDatasetId']}/items"
+        # limit: Apify no serializa más items de los que puede usar el TOP-N
+        f"?clean=true&fields={APIFY_ITEM_FIELDS}&limit={max_items}&token={APIFY_TOKEN}"
+    )
+    items_res = await _apify_request("GET", items_url)
+    items_res.raise_for_status()
+    return orjson.loads(items_res.content)
+
+
+async def _wait_for_run(run_id: str, estado: str | None) -> str:
+    """Espera a que el run termine y devuelve su estado final."""
+    status_url = (
+        f"{APIFY_API}/actor-runs/{run_id}"
+        f"?waitForFinish={APIFY_WAIT_FOR_FINISH_S}&token={APIFY_TOKEN}"
+    )
+    deadline = time.monotonic() + APIFY_POLL_TIMEOUT_S
+    attempt = 0
+    while estado not in APIFY_TERMINAL_STATUSES:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"La ejecución {run_id} de Apify sigue en estado {estado}")
+        started = time.monotonic()
+        status_res = await _apify_request("GET", status_url, timeout=APIFY_WAIT_TIMEOUT_S)
+        status_res.raise_for_status()
+        estado = orjson.loads(status_res.content)["data"]["status"]
+        # Si Apify ya ha esperado los N segundos, volvemos a preguntar sin pausa;
+        # solo dormimos (backoff) si ha contestado antes de tiempo
+        if estado not in APIFY_TERMINAL_STATUSES and time.monotonic() - started < APIFY_WAIT_FOR_FINISH_S:
+            await asyncio.sleep(_backoff(attempt))
+            attempt += 1
+    return estado
+
+
+def _store_in_cache(key: str, task: asyncio.Task[List[Dict[str, Any]]]) -> None:
+    _apify_inflight.pop(key, None)
+    if task.cancelled() or task.exception() is not None:
+        return
+    # Una lista vacía suele ser cuota agotada en Apify: no la fijamos en caché
+    if not task.result():
+        return
+
+    now = time.monotonic()
+    _purge_expired(_apify_cache, now)
+    _apify_cache[key] = (now, task.result())
+
+
+def _purge_expired(cache: Dict[Any, tuple[float, Any]], now: float) -> None:
+    for k in [k for k, (ts, _) in cache.items() if now - ts > CACHE_TTL_S]:
+        del cache[k]
+
+
+def _apify_cache_key(location: str, for_rent: bool, max_items: int) -> str:
+    return f"{location}:{'rent' if for_rent else 'sale'}:{max_items}"
+
+
+def _fetched_at(locations: List[str], for_rent: bool, max_items: int) -> float | None:
+    """
+    Momento de la ejecución de Apify más antigua en la que se basan estas
+    ubicaciones, o None si a alguna le falta resultado en caché (ha fallado
+    o ha vuelto vacía) y la respuesta no debe guardarse.
+    """
+    cached = [_apify_cache.get(_apify_cache_key(loc, for_rent, max_items)) for loc in locations]
+    if not cached or None in cached:
+        return None
+    return min(ts for ts, _ in cached)
+
+
+async def fetch_properties_from_apify(
+    location: str,
+    for_rent: bool,
+    max_items: int = APIFY_MAX_ITEMS,
+    max_age: int | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Devuelve los anuncios de Idealista para una ubicación.
+
+    Reutiliza el resultado cacheado si tiene menos de `max_age` segundos
+    (por defecto CACHE_TTL_S); con max_age=0 se fuerza una ejecución nueva.
+    """
+    key = _apify_cache_key(location, for_rent, max_items)
+    ttl = CACHE_TTL_S if max_age is None else max_age
+
+    cached = _apify_cache.get(key)
+    if cached and time.monotonic() - cached[0] <= ttl:
+        return cached[1]
+
+    task = _apify_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_run_actor(location, for_rent, max_items))
+        task.add_done_callback(lambda t: _store_in_cache(key, t))
+        _apify_inflight[key] = task
+
+    # shield: si un cliente se desconecta no cancelamos la ejecución compartida
+    return await asyncio.shield(task)
+
+
+async def fetch_many(
+    locations: List[str],
+    for_rent: bool,
+    max_items: int = APIFY_MAX_ITEMS,
+    max_age: int | None = None,
+) -> tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Lanza una búsqueda por ubicación en paralelo y junta los resultados.
+    Devuelve (items, ubicaciones que han fallado). Con varias ubicaciones,
+    cada item lleva su zona en "search_location".
+    """
+    if len(locations) == 1:
+        items = await fetch_properties_from_apify(
+            locations[0], for_rent, max_items=max_items, max_age=max_age
+        )
+        return items, []
+
+    results = await asyncio.gather(
+        *(
+            fetch_properties_from_apify(loc, for_rent, max_items=max_items, max_age=max_age)
+            for loc in locations
+        ),
+        return_exceptions=True,
+    )
+
+    items: List[Dict[str, Any]] = []
+    errors = []
+    failed: List[str] = []
+    for loc, res in zip(locations, results):
+        if isinstance(res, BaseException):
+            errors.append(res)
+            failed.append(loc)
+        elif isinstance(res, list):
+            items.extend({**item, "search_location": loc} for item in res)
+
+    # Solo fallamos si no ha respondido ninguna zona
+    if errors and len(errors) == len(locations):
+        raise errors[0]
+    return items, failed
+
 # -------------------------------------------------
 # Endpoint principal /buscar
 # -------------------------------------------------
 @app.get("/buscar")
-def buscar(q: str):
+async def buscar(q: str, max_age: int | None = None):
     # Comprobación de variables de entorno
     if not APIFY_TOKEN or not ACTOR_ID:
-        return JSONResponse(
+        return json_response(
             status_code=500,
             content={
                 "error": "Faltan APIFY_TOKEN o APIFY_ACTOR_ID en las variables de entorno."
@@ -209,7 +650,7 @@ def buscar(q: str):
     info = parse_query(q)
 
     if not info["ok"]:
-        return JSONResponse(
+        return json_response(
             status_code=400,
             content={
                 "error": "Falta información en la consulta.",
@@ -222,6 +663,13 @@ def buscar(q: str):
             },
         )
 
+    # Misma consulta interpretada y datos aún frescos: devolvemos el JSON ya hecho
+    cache_key = _parse_query_cached(q)
+    cached = _response_cache.get(cache_key)
+    ttl = CACHE_TTL_S if max_age is None else max_age
+    if cached and time.monotonic() - cached[0] <= ttl:
+        return Response(content=cached[1], media_type="application/json")
+
     ciudad = info["city"]
     price_max = info["price_max"]
     for_rent = info["for_rent"]
@@ -234,54 +682,29 @@ def buscar(q: str):
         rango_min = int(price_max * 0.7)
         rango_max = int(price_max * 1.2)
 
-    # --------- Llamada al actor lukass~idealista-scraper (sincronamente) ----------
-    run_input = {
-        "district": location_query or ciudad,
-        "country": "es",
-        "operation": "rent" if for_rent else "sale",
-        "propertyType": "homes",
-        "maxItems": 150,
-        "endPage": 50,
-        "proxy": {
-            "useApifyProxy": True,
-            "apifyProxyGroups": ["RESIDENTIAL"],
-        },
-        "minSize": "any",
-        "maxSize": "any",
-        "bedrooms": [],
-        "bathrooms": [],
-        "homeType": [],
-        "condition": [],
-        "propertyStatus": [],
-        "floorHeights": [],
-        "features": [],
-    }
-
-    apify_url = (
-        f"https://api.apify.com/v2/acts/{ACTOR_ID}/run-sync-get-dataset-items"
-        f"?token={APIFY_TOKEN}"
-    )
-
+    locations = info["locations"] or [ciudad]
+    max_items = apify_max_items(num_props)
     try:
-        resp = requests.post(apify_url, json=run_input, timeout=300)
-        resp.raise_for_status()
-        items = resp.json()
+        items, failed_locations = await fetch_many(
+            locations, for_rent, max_items=max_items, max_age=max_age
+        )
     except Exception as e:
-        return JSONResponse(
+        return json_response(
             status_code=502,
             content={"error": f"Error llamando a Apify: {repr(e)}"},
         )
 
     if not isinstance(items, list) or not items:
-        return JSONResponse(
+        return json_response(
             status_code=404,
             content={"error": "No se encontraron pisos para esta búsqueda."},
         )
 
-    # 1) Solo pisos con precio válido
-    con_precio = [p for p in items if safe_price(p) > 0]
+    # 1) Solo pisos con precio válido; guardamos (precio, piso) para no
+    #    volver a calcular el precio al filtrar, ordenar y formatear
+    con_precio = [(precio, p) for p in items if (precio := safe_price(p)) > 0]
     if not con_precio:
-        return JSONResponse(
+        return json_response(
             status_code=404,
             content={"error": "No se encontraron pisos con precio válido."},
         )
@@ -289,32 +712,27 @@ def buscar(q: str):
     # 2) Filtramos por banda de precio [-30%, +20%]
     candidatos = con_precio
     if rango_min is not None and rango_max is not None:
-        banda = [p for p in con_precio if rango_min <= safe_price(p) <= rango_max]
+        banda = [c for c in con_precio if rango_min <= c[0] <= rango_max]
         if banda:
             candidatos = banda
 
-    # 3) Orden por precio (más baratos primero)
-    candidatos_ordenados = sorted(candidatos, key=safe_price)
+    # 3-4) TOP N más baratos, sin ordenar la lista completa
+    top = heapq.nsmallest(max(num_props, 1), candidatos, key=itemgetter(0))
 
-    # 4) TOP N
-    top = candidatos_ordenados[: max(num_props, 1)]
+    # Valores comunes a todas las propiedades: se calculan una sola vez
+    operacion = "Alquiler" if for_rent else "Compra"
 
     propiedades_salida = []
-    for i, piso in enumerate(top, start=1):
-        precio = safe_price(piso)
+    for i, (precio, piso) in enumerate(top, start=1):
         direccion = piso.get("address") or "Dirección no especificada"
         url = piso.get("url") or ""
-        fotos = piso.get("photos") or []
-        if isinstance(fotos, list) and fotos:
-            foto = fotos[0].get("url") or ""
-        else:
-            foto = ""
+        foto = piso.get("photo") or ""
         typology = piso.get("typology") or "vivienda"
         title = piso.get("title") or f"{typology.capitalize()} en {direccion}"
 
         rent_estimate = None
         if not for_rent and precio > 0:
-            rent_estimate = int(precio * 0.04 / 12)
+            rent_estimate = estimate_monthly_rent(precio)
 
         propiedades_salida.append(
             {
@@ -324,21 +742,25 @@ def buscar(q: str):
                 "price": precio,
                 "url": url,
                 "photo": foto,
-                "operation": "Alquiler" if for_rent else "Compra",
+                "operation": operacion,
                 "typology": typology,
                 "rent_estimate": rent_estimate,
+                "search_location": piso.get("search_location", locations[0]),
             }
         )
 
-    precios_top = [p["price"] for p in propiedades_salida if p["price"] > 0]
+    # top viene ordenado por precio y solo tiene precios > 0: mínimo y máximo
+    # son el primero y el último, sin recorrer la salida otra vez
     meta = {
         "city": ciudad,
         "location_query": location_query,
+        "locations": info["locations"],
+        "failed_locations": failed_locations,
         "price_max": price_max,
         "price_band_min": rango_min,
         "price_band_max": rango_max,
-        "found_min_price": min(precios_top) if precios_top else None,
-        "found_max_price": max(precios_top) if precios_top else None,
+        "found_min_price": top[0][0] if top else None,
+        "found_max_price": top[-1][0] if top else None,
         "for_rent": for_rent,
         "num_props": num_props,
         "total_scraped": len(items),
@@ -347,7 +769,7 @@ def buscar(q: str):
 
     intro = build_intro(info, rango_min, rango_max)
 
-    return JSONResponse(
+    response = json_response(
         content={
             "intro": intro,
             "properties": propiedades_salida,
@@ -355,6 +777,90 @@ def buscar(q: str):
         }
     )
 
+    # Si alguna zona ha fallado, la próxima búsqueda vuelve a intentarlo
+    fetched_at = _fetched_at(locations, for_rent, max_items)
+    if fetched_at is not None:
+        _purge_expired(_response_cache, time.monotonic())
+        _response_cache.pop(cache_key, None)
+        while len(_response_cache) >= RESPONSE_CACHE_MAXSIZE:
+            del _response_cache[next(iter(_response_cache))]
+        _response_cache[cache_key] = (fetched_at, response.body)
+    return response
+
+# -------------------------------------------------
+# /buscar en segundo plano: POST lanza la búsqueda y devuelve un job_id,
+# GET /buscar/jobs/{job_id} espera (long-poll) hasta que haya resultado
+# -------------------------------------------------
+JOB_WAIT_S = 20
+JOB_TTL_S = CACHE_TTL_S
+# Búsquedas en marcha a la vez (cada una puede ser un run de pago); por
+# encima se contesta 429. Y como mucho JOB_MAX_STORED jobs guardados: al
+# llenarse se olvidan primero los terminados más antiguos.
+JOB_MAX_PENDING = 4 * APIFY_MAX_CONCURRENT_RUNS
+JOB_MAX_STORED = 512
+
+# job_id -> (momento de creación, tarea que ejecuta /buscar).
+# Vive en memoria del proceso: el GET tiene que llegar al mismo worker que
+# el POST, por eso startup.txt arranca gunicorn con un único worker (ver README).
+_jobs: Dict[str, tuple[float, asyncio.Task[Response]]] = {}
+
+
+def _job_pending(job_id: str) -> Response:
+    return json_response(status_code=202, content={"job_id": job_id, "status": "running"})
+
+
+async def _run_job(q: str, max_age: int | None) -> Response:
+    # La tarea nunca termina con excepción: cada consulta del job devuelve
+    # el mismo 502 y no queda ningún error sin recoger si nadie pregunta
+    try:
+        return await buscar(q, max_age)
+    except Exception as e:
+        return json_response(
+            status_code=502,
+            content={"error": f"Error en la búsqueda: {repr(e)}"},
+        )
+
+
+@app.post("/buscar/jobs")
+async def crear_busqueda(q: str, max_age: int | None = None):
+    now = time.monotonic()
+    for job_id, (created, task) in list(_jobs.items()):
+        if task.done() and now - created > JOB_TTL_S:
+            del _jobs[job_id]
+
+    terminados = [job_id for job_id, (_, task) in _jobs.items() if task.done()]
+    if len(_jobs) - len(terminados) >= JOB_MAX_PENDING:
+        return json_response(
+            status_code=429,
+            content={"error": "Demasiadas búsquedas en marcha; inténtalo en unos segundos."},
+        )
+    # Hay sitio para los pendientes (JOB_MAX_PENDING < JOB_MAX_STORED):
+    # los que sobran salen de entre los terminados, en orden de creación
+    for job_id in terminados[: max(len(_jobs) + 1 - JOB_MAX_STORED, 0)]:
+        del _jobs[job_id]
+
+    job_id = uuid.uuid4().hex
+    _jobs[job_id] = (now, asyncio.create_task(_run_job(q, max_age)))
+    return _job_pending(job_id)
+
+
+@app.get("/buscar/jobs/{job_id}")
+async def resultado_busqueda(job_id: str, wait: int = JOB_WAIT_S):
+    job = _jobs.get(job_id)
+    if job is None:
+        return json_response(
+            status_code=404,
+            content={"error": "Búsqueda no encontrada o caducada."},
+        )
+
+    # shield: si el cliente se desconecta o vence la espera, la búsqueda sigue
+    try:
+        return await asyncio.wait_for(
+            asyncio.shield(job[1]), timeout=min(max(wait, 0), JOB_WAIT_S)
+        )
+    except asyncio.TimeoutError:
+        return _job_pending(job_id)
+
 # -------------------------------------------------
 # Healthcheck para Azure
 # -------------------------------------------------
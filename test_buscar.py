@@ -0,0 +1,112 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+def anuncio(direccion, precio=200000):
+    return {
+        "price": precio,
+        "address": direccion,
+        "url": "u",
+        "photo": "",
+        "typology": "flat",
+        "title": None,
+    }
+
+
+class ActorFalso:
+    """Sustituye a _run_actor: cuenta las ejecuciones y falla en las zonas indicadas."""
+
+    def __init__(self):
+        self.runs = []
+        self.fallan = set()
+
+    async def __call__(self, location, for_rent, max_items):
+        self.runs.append(location)
+        if location in self.fallan:
+            raise RuntimeError(f"fallo en {location}")
+        return [anuncio(f"calle de {location}")]
+
+
+@pytest.fixture
+def actor(monkeypatch):
+    monkeypatch.setattr(main, "APIFY_TOKEN", "token")
+    monkeypatch.setattr(main, "ACTOR_ID", "actor")
+    falso = ActorFalso()
+    monkeypatch.setattr(main, "_run_actor", falso)
+    main._apify_cache.clear()
+    main._response_cache.clear()
+    yield falso
+    main._apify_cache.clear()
+    main._response_cache.clear()
+
+
+@pytest.fixture
+def client(actor):
+    with TestClient(main.app) as c:
+        yield c
+
+
+def test_buscar_varias_ciudades_con_fallo_parcial(actor, client):
+    actor.fallan = {"barcelona"}
+
+    r = client.get("/buscar", params={"q": "pisos en madrid y barcelona por 200000"})
+
+    assert r.status_code == 200
+    body = r.json()
+    assert body["meta"]["locations"] == ["madrid", "barcelona"]
+    assert body["meta"]["failed_locations"] == ["barcelona"]
+    assert [p["search_location"] for p in body["properties"]] == ["madrid"]
+
+
+def test_fallo_parcial_no_se_cachea(actor, client):
+    q = "pisos en madrid y barcelona por 200000"
+    actor.fallan = {"barcelona"}
+    client.get("/buscar", params={"q": q})
+
+    assert main._fetched_at(["madrid", "barcelona"], False, main.apify_max_items(5)) is None
+    assert main._response_cache == {}
+
+    # Barcelona se recupera: se vuelve a pedir y la respuesta ya es completa
+    actor.fallan = set()
+    body = client.get("/buscar", params={"q": q}).json()
+
+    assert actor.runs == ["madrid", "barcelona", "barcelona"]
+    assert body["meta"]["failed_locations"] == []
+    assert len(main._response_cache) == 1
+
+
+def test_max_age_cero_salta_las_dos_caches(actor, client):
+    q = "pisos en madrid por 200000"
+    client.get("/buscar", params={"q": q})
+    client.get("/buscar", params={"q": q})
+    assert actor.runs == ["madrid"]
+
+    client.get("/buscar", params={"q": q, "max_age": 0})
+    assert actor.runs == ["madrid", "madrid"]
+
+
+def test_ciclo_de_vida_de_un_job(actor, client):
+    main._jobs.clear()
+
+    r = client.post("/buscar/jobs", params={"q": "pisos en madrid por 200000"})
+    assert r.status_code == 202
+    job_id = r.json()["job_id"]
+
+    r = client.get(f"/buscar/jobs/{job_id}")
+    assert r.status_code == 200
+    assert r.json()["meta"]["locations"] == ["madrid"]
+
+    assert client.get("/buscar/jobs/no-existe").status_code == 404
+    main._jobs.clear()
+
+
+def test_demasiados_jobs_en_marcha(actor, client, monkeypatch):
+    main._jobs.clear()
+    monkeypatch.setattr(main, "JOB_MAX_PENDING", 0)
+
+    r = client.post("/buscar/jobs", params={"q": "pisos en madrid por 200000"})
+
+    assert r.status_code == 429
+    assert main._jobs == {}
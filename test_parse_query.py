@@ -0,0 +1,140 @@
+import pytest
+
+from main import parse_query, safe_price
+
+FALTA_PRESUPUESTO = "presupuesto máximo (ej. 'por 300000 euros')"
+FALTA_UBICACION = "ubicación (ciudad, barrio, código postal o calle)"
+
+
+def esperado(**campos):
+    base = {
+        "ok": True,
+        "missing": [],
+        "location_query": None,
+        "locations": [],
+        "city": "madrid",
+        "price_max": None,
+        "for_rent": False,
+        "num_props": 5,
+    }
+    base.update(campos)
+    return base
+
+
+CASOS = [
+    (
+        "Busca 5 pisos para comprar en Legazpi, Madrid por 300000 euros",
+        esperado(
+            location_query="legazpi, madrid",
+            locations=["legazpi, madrid"],
+            price_max=300000,
+        ),
+    ),
+    (
+        "Quiero 3 pisos en código postal 28005 para alquilar por 150 mil",
+        esperado(
+            location_query="código postal 28005",
+            locations=["código postal 28005"],
+            city="código",
+            price_max=150000,
+            for_rent=True,
+            num_props=3,
+        ),
+    ),
+    # Código postal sin " en ": se toma del propio texto
+    (
+        "3 pisos 28005 por 200000",
+        esperado(
+            location_query="28005",
+            locations=["28005"],
+            city="28005",
+            price_max=200000,
+            num_props=3,
+        ),
+    ),
+    # Tildes: la ubicación se muestra como se escribió, la ciudad se busca por su nombre
+    (
+        "3 pisos en Málaga por 200000",
+        esperado(
+            location_query="málaga",
+            locations=["malaga"],
+            city="malaga",
+            price_max=200000,
+            num_props=3,
+        ),
+    ),
+    # Varias ciudades: una búsqueda por ciudad; la principal sigue el orden de _CIUDADES
+    (
+        "pisos en sevilla, málaga o Córdoba por 150 mil",
+        esperado(
+            location_query="sevilla, málaga o córdoba",
+            locations=["sevilla", "malaga", "cordoba"],
+            city="malaga",
+            price_max=150000,
+        ),
+    ),
+    # Sin " en " no se buscan varias ciudades en toda la frase
+    (
+        "madrid y barcelona",
+        esperado(
+            ok=False,
+            missing=[FALTA_PRESUPUESTO],
+            location_query="madrid",
+            locations=["madrid"],
+        ),
+    ),
+    # "rentable" no es alquiler; "alquiler" sí
+    (
+        "piso rentable en madrid por 200000",
+        esperado(location_query="madrid", locations=["madrid"], price_max=200000),
+    ),
+    (
+        "piso de alquiler en madrid por 1000 euros",
+        esperado(
+            location_query="madrid",
+            locations=["madrid"],
+            price_max=1000,
+            for_rent=True,
+        ),
+    ),
+    # "valencia" es parte de la calle: manda barcelona por prioridad
+    (
+        "piso en calle valencia, barcelona por 300000",
+        esperado(
+            location_query="calle valencia, barcelona",
+            locations=["calle valencia, barcelona"],
+            city="barcelona",
+            price_max=300000,
+        ),
+    ),
+    (
+        "pisos baratos",
+        esperado(ok=False, missing=[FALTA_PRESUPUESTO, FALTA_UBICACION]),
+    ),
+]
+
+
+@pytest.mark.parametrize("q, info", CASOS)
+def test_parse_query(q, info):
+    assert parse_query(q) == info
+
+
+PRECIOS = [
+    (439000, 439000),
+    (439000.7, 439000),
+    ("439000", 439000),
+    ("439.000 €", 439000),
+    ("439 000€", 439000),
+    ("1.234.567", 1234567),
+    # Decimales, signos o basura: no son un precio
+    ("299000.50", -1),
+    ("1.5", -1),
+    ("-5", -1),
+    ("", -1),
+    (None, -1),
+]
+
+
+@pytest.mark.parametrize("precio, valor", PRECIOS)
+def test_safe_price(precio, valor):
+    assert safe_price({"price": precio}) == valor